@@ -1,9 +1,11 @@
 from __future__ import annotations
 
+import asyncio
+import functools
 import logging
 from dataclasses import dataclass
 from contextlib import AsyncExitStack, asynccontextmanager
-from typing import Optional, Iterable, Collection, List, get_type_hints
+from typing import Optional, Iterable, Collection, Dict, List, Set, Tuple, Any, get_type_hints
 
 from .helpers import *
 
@@ -19,6 +21,8 @@ __all__ = [
 
 logger = logging.getLogger('deei')
 
+_missing = object()
+_analyzing = object()
 
 @asynccontextmanager
 async def bootstrap(target):
@@ -62,18 +66,79 @@ def get_module_metadata(target) -> ModuleMetadata:
     return getattr(target, '_deei_module_')
 
 
+@functools.lru_cache(maxsize=None)
 def get_dependency_name(target) -> str:
     return camelcase_into_snakecase(target.__name__)
 
 
+def _fast_type_hints(obj) -> Dict[str, Any]:
+    """Type hints of obj, skipping get_type_hints when there is nothing to resolve."""
+    annotations = getattr(obj, '__annotations__', {})
+    if any(isinstance(hint, str) for hint in annotations.values()):
+        return get_type_hints(obj)
+    return dict(annotations)
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_type_hints(obj) -> Tuple[Tuple[str, Any], ...]:
+    """Type hints of obj as (name, hint) pairs, without the 'return' hint."""
+    return tuple(
+        (name, hint)
+        for name, hint in _fast_type_hints(obj).items()
+        if name != 'return'
+    )
+
+
 @dataclass
 class ModuleMetadata:
+    __slots__ = ('providers', 'exports', 'imports')
+
     providers: Collection
     exports: Collection
     imports: Collection
 
 
 class IDeeiContext:
+    __slots__ = ()
+
+    def _analyze(self, key: Optional[Tuple[str, bool]]) -> bool:
+        """Check the lookups key leads to for cycles; True if resolving it can suspend.
+
+        The module graph is fixed, so this follows the same path as
+        _get_dependency and __aenter__ would, before anything is awaited.
+        Concurrently resolved siblings would otherwise wait on each
+        other's locks forever. Resolution can only suspend when some
+        target on the path is an async context manager.
+        """
+        may_suspend = self._may_suspend.get(key)
+        if may_suspend is _analyzing:
+            raise InjectionError(f'{self!r}: Circular dependency ', self._name if key is None else key[0])
+        if may_suspend is not None:
+            return may_suspend
+
+        self._may_suspend[key] = _analyzing
+        try:
+            may_suspend = False
+            if key is None:
+                may_suspend = self._target_is_acm
+                for attr_name, attr_hint in self._get_init_hints():
+                    may_suspend = self._analyze((attr_name, False)) or may_suspend
+            else:
+                name, for_parent = key
+                context = self._resolution_table.get(name)
+                if context is not None:
+                    may_suspend = context._analyze(None)
+                    if name not in self._providers_by_name:
+                        may_suspend = context._analyze((name, True)) or may_suspend
+                elif not for_parent and isinstance(self._parent, DeeiContext) and self._parent.can_provide(name):
+                    may_suspend = self._parent._analyze((name, False))
+        except BaseException:
+            # Forget the partial walk so the next lookup raises again.
+            del self._may_suspend[key]
+            raise
+
+        self._may_suspend[key] = may_suspend
+        return may_suspend
 
     async def get_target(self): ...
 
@@ -89,6 +154,7 @@ class IDeeiContext:
 
 
 class DeeiNullContext(IDeeiContext):
+    __slots__ = ()
 
     async def get_target(self):
         raise NotImplementedError(f'{type(self).__name__} has no target')
@@ -106,68 +172,144 @@ class DeeiNullContext(IDeeiContext):
         return False
 
 
-class DeeiContext(IDeeiContext):
+_null_context = DeeiNullContext()
+
 
-    def __init__(self, target, parent: DeeiContext = DeeiNullContext()) -> None:
+class DeeiContext(IDeeiContext):
+    __slots__ = (
+        '_target', '_parent', '_name',
+        '_aentered', '_aenter_lock', '_exit_stack',
+        '_providers', '_imports', '_exports',
+        '_dependencies', '_dependency_locks', '_init_hints',
+        '_is_module', '_target_is_acm',
+        '_providers_by_name', '_provided_names', '_export_names',
+        '_can_provide_cache', '_can_export_cache', '_may_suspend',
+        '_resolution_table',
+        '_target_instance', '_target_is_initialized',
+    )
+
+    def __init__(self, target, parent: IDeeiContext = _null_context) -> None:
         self._target = target
         self._parent = parent
+        self._name = get_dependency_name(self._target)
 
         self._aentered = False
-        self._exit_stack = AsyncExitStack()
+        self._aenter_lock: Optional[asyncio.Lock] = None
+        self._exit_stack: Optional[AsyncExitStack] = None
 
         self._providers: List[DeeiContext] = []
         self._imports: List[DeeiContext] = []
         self._exports: List[DeeiContext] = []
 
         self._dependencies = {}
+        self._dependency_locks: Dict[str, asyncio.Lock] = {}
+        self._init_hints: Optional[Tuple[Tuple[str, Any], ...]] = None
 
+        self._target_is_acm = hasattr(self._target, '__aenter__') and hasattr(self._target, '__aexit__')
         self._is_module = is_module(self._target)
-        if is_module(self._target):
+        if self._is_module:
             module_metadata = get_module_metadata(self._target)
 
-            for provider in module_metadata.providers:
-                provider_context = DeeiContext(provider, self)
-                self._providers.append(provider_context)
+            self._providers = [DeeiContext(provider, self) for provider in module_metadata.providers]
+            self._imports = [DeeiContext(import_, self) for import_ in module_metadata.imports]
 
-            for import_ in module_metadata.imports:
-                import_context = DeeiContext(import_, self)
-                self._imports.append(import_context)
-                if import_ in module_metadata.exports:
-                    self._exports.append(import_context)
+            exports = set(module_metadata.exports)
+            self._exports = [
+                import_context
+                for import_context, import_ in zip(self._imports, module_metadata.imports)
+                if import_ in exports
+            ]
+
+        # The first provider with a given name wins, as with imports.
+        self._providers_by_name: Dict[str, DeeiContext] = {}
+        for provider in self._providers:
+            self._providers_by_name.setdefault(provider.get_name(), provider)
+        self._provided_names: Optional[Set[str]] = None
+        self._export_names: Optional[Set[str]] = None
+
+        self._can_provide_cache: Dict[Tuple[str, bool], bool] = {}
+        self._can_export_cache: Dict[str, bool] = {}
+        # Lookups, as (name, for_parent), checked for dependency cycles and
+        # whether resolving them can suspend; None stands for entering the
+        # context itself. Holds _analyzing while a lookup is being walked.
+        self._may_suspend: Dict[Optional[Tuple[str, bool]], Any] = {}
+
+        # Where each dependency resolvable without the parent comes from.
+        # The parent is consulted separately, since it is not fully
+        # constructed yet and lookups made for the parent must skip it.
+        self._resolution_table: Dict[str, DeeiContext] = dict(self._providers_by_name)
+        for import_context in self._imports:
+            for name in import_context._get_export_names():
+                self._resolution_table.setdefault(name, import_context)
 
         self._target_instance = None
         self._target_is_initialized = False
 
     def get_name(self) -> str:
-        return camelcase_into_snakecase(self._target.__name__)
+        return self._name
 
     def can_provide(self, name: str, for_parent: bool = False) -> bool:
-        for provider in self._providers:
-            if name == provider.get_name():
+        cached = self._can_provide_cache.get((name, for_parent))
+        if cached is not None:
+            return cached
+
+        result = self._can_provide_cache[name, for_parent] = self._can_provide(name, for_parent)
+        return result
+
+    def _can_provide(self, name: str, for_parent: bool) -> bool:
+        # Walk up the parents in a loop rather than recursing through
+        # each parent's can_provide.
+        context = self
+        while isinstance(context, DeeiContext):
+            if name in context._get_provided_names():
                 return True
+            if for_parent:
+                return False
+            context = context._parent
 
-        for import_ in self._imports:
-            if import_.can_provide(name, for_parent=True):
-                return True
+        return context.can_provide(name)
 
-        if not for_parent and self._parent.can_provide(name):
-            return True
+    def can_export(self, name: str) -> bool:
+        cached = self._can_export_cache.get(name)
+        if cached is not None:
+            return cached
 
-        return False
+        result = self._can_export_cache[name] = self._can_export(name)
+        return result
 
-    def can_export(self, name: str) -> bool:
+    def _can_export(self, name: str) -> bool:
         if not self._is_module:
             return False
 
-        for provider in self._providers:
-            if name == provider.get_name():
-                return True
-
-        for export in self._exports:
-            if export.can_provide(name, for_parent=True):
-                return True
+        if name in self._providers_by_name:
+            return True
 
-        return False
+        return name in self._get_export_names()
+
+    def _get_init_hints(self) -> Tuple[Tuple[str, Any], ...]:
+        # Resolved on first use: a provider that is never requested may
+        # have annotations that cannot be resolved at runtime.
+        if self._init_hints is None:
+            self._init_hints = _cached_type_hints(self._target.__init__)
+        return self._init_hints
+
+    def _get_provided_names(self) -> Set[str]:
+        """Names provided by the Context itself or by its imports."""
+        if self._provided_names is None:
+            names = set(self._providers_by_name)
+            for import_ in self._imports:
+                names |= import_._get_provided_names()
+            self._provided_names = names
+        return self._provided_names
+
+    def _get_export_names(self) -> Set[str]:
+        """Names the Context can provide to its parent Context."""
+        if self._export_names is None:
+            names = set(self._providers_by_name)
+            for export in self._exports:
+                names |= export._get_provided_names()
+            self._export_names = names
+        return self._export_names
 
     async def get_target(self):
         return self._target_instance
@@ -176,17 +318,36 @@ class DeeiContext(IDeeiContext):
         if name in self._dependencies:
             return self._dependencies[name]
 
-        for provider in self._providers:
-            if name == provider.get_name():
-                await self._exit_stack.enter_async_context(provider)
-                dependency = self._dependencies[name] = await provider.get_target()
-                return dependency
-
-        for import_ in self._imports:
-            if import_.can_export(name):
-                await self._exit_stack.enter_async_context(import_)
-                dependency = self._dependencies[name] = await import_.get_dependency(name, for_parent=True)
-                return dependency
+        key = (name, for_parent)
+        may_suspend = self._may_suspend.get(key)
+        if may_suspend is None:
+            may_suspend = self._analyze(key)
+
+        # Nothing else can run while a lookup that never suspends is being
+        # resolved, so only the others need a lock.
+        if not may_suspend:
+            return await self._get_dependency(name, for_parent)
+
+        # Concurrent requests for the same dependency wait for the first one
+        # instead of initializing it again.
+        lock = self._dependency_locks.get(name)
+        if lock is None:
+            lock = self._dependency_locks[name] = asyncio.Lock()
+        async with lock:
+            if name in self._dependencies:
+                return self._dependencies[name]
+            return await self._get_dependency(name, for_parent)
+
+    async def _get_dependency(self, name: str, for_parent: bool):
+        context = self._resolution_table.get(name)
+        if context is not None:
+            await self._get_exit_stack().enter_async_context(context)
+            if name in self._providers_by_name:
+                dependency = await context.get_target()
+            else:
+                dependency = await context.get_dependency(name, for_parent=True)
+            self._dependencies[name] = dependency
+            return dependency
 
         if not for_parent and self._parent.can_provide(name):
             return await self._parent.get_dependency(name)
@@ -197,27 +358,92 @@ class DeeiContext(IDeeiContext):
         if self._aentered:
             return self
 
+        may_suspend = self._may_suspend.get(None)
+        if may_suspend is None:
+            may_suspend = self._analyze(None)
+
+        if not may_suspend:
+            await self._enter()
+            return self
+
+        # Created lazily so the lock belongs to the running event loop.
+        if self._aenter_lock is None:
+            self._aenter_lock = asyncio.Lock()
+
+        async with self._aenter_lock:
+            if self._aentered:
+                return self
+
+            await self._enter()
+
+        return self
+
+    async def _enter(self) -> None:
+        try:
+            await self._initialize_target()
+        except BaseException:
+            # Close whatever was entered before the failure.
+            await self._get_exit_stack().aclose()
+            raise
+
+        self._aentered = True
+
+    async def _initialize_target(self) -> None:
+        # Already resolved dependencies are taken as is, without
+        # creating a get_dependency coroutine for them.
         to_inject = {}
-        for attr_name, attr_hint in get_type_hints(self._target.__init__).items():
-            if attr_name == 'return':
-                continue
-            to_inject[attr_name] = await self.get_dependency(attr_name)
+        missing_names = []
+        for attr_name, attr_hint in self._get_init_hints():
+            value = self._dependencies.get(attr_name, _missing)
+            if value is _missing:
+                missing_names.append(attr_name)
+            to_inject[attr_name] = value
+
+        # Lookups that never suspend cannot overlap, so they are awaited
+        # in place; only the rest are resolved concurrently.
+        suspending_names = []
+        for attr_name in missing_names:
+            if self._may_suspend[attr_name, False]:
+                suspending_names.append(attr_name)
+            else:
+                to_inject[attr_name] = await self.get_dependency(attr_name)
+
+        if len(suspending_names) == 1:
+            to_inject[suspending_names[0]] = await self.get_dependency(suspending_names[0])
+        elif suspending_names:
+            values = await self._gather_dependencies(suspending_names)
+            to_inject.update(zip(suspending_names, values))
 
         instance = self._target(**to_inject)
 
-        if hasattr(instance, '__aenter__') and hasattr(instance, '__aexit__'):
-            logger.debug(f'{type(instance).__name__} is an async context manager')
-            await self._exit_stack.enter_async_context(instance)
+        if self._target_is_acm:
+            logger.debug('%s is an async context manager', type(instance).__name__)
+            await self._get_exit_stack().enter_async_context(instance)
 
         self._target_instance = instance
         self._target_is_initialized = True
 
-        self._aentered = True
-        return self
+    async def _gather_dependencies(self, names: List[str]) -> List[Any]:
+        """Resolve dependencies concurrently, cancelling the rest if one fails."""
+        tasks = [asyncio.ensure_future(self.get_dependency(name)) for name in names]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    def _get_exit_stack(self) -> AsyncExitStack:
+        # Allocated on first use, since many contexts are only ever queried.
+        if self._exit_stack is None:
+            self._exit_stack = AsyncExitStack()
+        return self._exit_stack
 
     async def __aexit__(self, exc_type, exc_val, exc_tb) -> Optional[bool]:
-        logger.debug(f'{self!r}: __aexit__')
-        await self._exit_stack.aclose()
+        logger.debug('%r: __aexit__', self)
+        if self._exit_stack is not None:
+            await self._exit_stack.aclose()
         return None
 
     def __repr__(self) -> str:
@@ -1,4 +1,4 @@
-import re
+import functools
 
 
 __all__ = [
@@ -7,12 +7,21 @@ __all__ = [
 ]
 
 
-_camel_case_word_bound_pattern = re.compile(r'([^A-Z])([A-Z])')
-
-
+@functools.lru_cache(maxsize=4096)
 def camelcase_into_snakecase(s: str) -> str:
-    return _camel_case_word_bound_pattern.sub(r'\1_\2', s).lower()
-
-
+    out = []
+    prev_is_upper = True
+    for ch in s:
+        is_upper = 'A' <= ch <= 'Z'
+        if is_upper and not prev_is_upper:
+            out.append('_')
+        out.append(ch)
+        prev_is_upper = is_upper
+    return ''.join(out).lower()
+
+
+@functools.lru_cache(maxsize=4096)
 def snakecase_into_camelcase(s: str) -> str:
+    if not s:
+        return s
     return s[0] + s.replace('_', ' ').title().replace(' ', '')[1:]
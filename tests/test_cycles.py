@@ -0,0 +1,51 @@
+import asyncio
+import unittest
+
+from deei import bootstrap, module, InjectionError
+
+
+class A:
+
+    def __init__(self, b: 'B'):
+        self.b = b
+
+
+class B:
+
+    def __init__(self, a: A):
+        self.a = a
+
+
+@module(providers=[A, B])
+class SiblingCycleModule:
+
+    def __init__(self, a: A, b: B):
+        pass
+
+
+@module(providers=[A, B])
+class ChainCycleModule:
+
+    def __init__(self, a: A):
+        pass
+
+
+class CircularDependencyTest(unittest.IsolatedAsyncioTestCase):
+
+    async def _bootstrap(self, target):
+        async with bootstrap(target):
+            pass
+
+    async def test_chain_cycle_raises(self):
+        with self.assertRaises(InjectionError):
+            await asyncio.wait_for(self._bootstrap(ChainCycleModule), 3)
+
+    async def test_sibling_cycle_raises(self):
+        # Both dependencies are resolved concurrently and each one waits
+        # for the other; this used to hang instead of raising.
+        with self.assertRaises(InjectionError):
+            await asyncio.wait_for(self._bootstrap(SiblingCycleModule), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()